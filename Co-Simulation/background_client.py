@@ -14,6 +14,7 @@ from __future__ import print_function
 
 import argparse
 import collections
+import concurrent.futures
 import datetime
 import glob
 import logging
@@ -22,6 +23,7 @@ import os
 import random
 import re
 import sys
+import threading
 import weakref
 import time
 
@@ -96,15 +98,30 @@ from agents.navigation.basic_agent import BasicAgent
 # -- Global functions ----------------------------------------------------------
 # ==============================================================================
 
+_WEATHER_NAME_RGX = re.compile('.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)')
+_WEATHER_PRESET_RGX = re.compile('[A-Z].+')
+_WEATHER_PRESETS = None
+
+
 def find_weather_presets():
-    rgx = re.compile('.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)')
-    name = lambda x: ' '.join(m.group(0) for m in rgx.finditer(x))
-    presets = [x for x in dir(carla.WeatherParameters) if re.match('[A-Z].+', x)]
-    return [(getattr(carla.WeatherParameters, x), name(x)) for x in presets]
+    # The presets are fixed for the lifetime of the carla module.
+    global _WEATHER_PRESETS
+    if _WEATHER_PRESETS is None:
+        name = lambda x: ' '.join(m.group(0) for m in _WEATHER_NAME_RGX.finditer(x))
+        presets = [x for x in dir(carla.WeatherParameters) if _WEATHER_PRESET_RGX.match(x)]
+        _WEATHER_PRESETS = [(getattr(carla.WeatherParameters, x), name(x)) for x in presets]
+    return _WEATHER_PRESETS
+
+
+# Display names keyed by blueprint type_id; there are only a few dozen of them.
+_DISPLAY_NAMES = {}
 
 
 def get_actor_display_name(actor, truncate=250):
-    name = ' '.join(actor.type_id.replace('_', '.').title().split('.')[1:])
+    type_id = actor.type_id
+    name = _DISPLAY_NAMES.get(type_id)
+    if name is None:
+        name = _DISPLAY_NAMES[type_id] = ' '.join(type_id.replace('_', '.').title().split('.')[1:])
     return (name[:truncate - 1] + u'\u2026') if len(name) > truncate else name
 
 
@@ -158,6 +175,8 @@ class World(object):
             spawn_points = self.map.get_spawn_points()
             spawn_point = random.choice(spawn_points) if spawn_points else carla.Transform()
             self.player = self.world.try_spawn_actor(blueprint, spawn_point)
+        # The HUD's cached actor list may still hold the destroyed player.
+        self.hud.invalidate_vehicles()
         # Set up the sensors.
         self.collision_sensor = CollisionSensor(self.player, self.hud)
         self.lane_invasion_sensor = LaneInvasionSensor(self.player, self.hud)
@@ -204,6 +223,8 @@ class World(object):
 
 
 class KeyboardControl(object):
+    _VEHICLE_KEYS = frozenset((K_UP, K_DOWN, K_LEFT, K_RIGHT, K_w, K_a, K_s, K_d, K_SPACE))
+
     def __init__(self, world, start_in_autopilot):
         self._autopilot_enabled = start_in_autopilot
         if isinstance(world.player, carla.Vehicle):
@@ -216,24 +237,29 @@ class KeyboardControl(object):
         else:
             raise NotImplementedError("Actor type not supported")
         self._steer_cache = 0.0
+        self._keys_down = set()
         world.hud.notification("Press 'H' or '?' for help.", seconds=4.0)
 
     def parse_events(self, client, world, clock):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 return True
+            elif event.type == pygame.KEYDOWN:
+                self._keys_down.add(event.key)
             elif event.type == pygame.KEYUP:
-                if self._is_quit_shortcut(event.key):
+                self._keys_down.discard(event.key)
+                mods = pygame.key.get_mods()
+                if self._is_quit_shortcut(event.key, mods):
                     return True
                 elif event.key == K_BACKSPACE:
                     world.restart()
                 elif event.key == K_F1:
                     world.hud.toggle_info()
-                elif event.key == K_h or (event.key == K_SLASH and pygame.key.get_mods() & KMOD_SHIFT):
+                elif event.key == K_h or (event.key == K_SLASH and mods & KMOD_SHIFT):
                     world.hud.help.toggle()
                 elif event.key == K_TAB:
                     world.camera_manager.toggle_camera()
-                elif event.key == K_c and pygame.key.get_mods() & KMOD_SHIFT:
+                elif event.key == K_c and mods & KMOD_SHIFT:
                     world.next_weather(reverse=True)
                 elif event.key == K_c:
                     world.next_weather()
@@ -241,9 +267,9 @@ class KeyboardControl(object):
                     world.camera_manager.next_sensor()
                 elif event.key > K_0 and event.key <= K_9:
                     world.camera_manager.set_sensor(event.key - 1 - K_0)
-                elif event.key == K_r and not (pygame.key.get_mods() & KMOD_CTRL):
+                elif event.key == K_r and not (mods & KMOD_CTRL):
                     world.camera_manager.toggle_recording()
-                elif event.key == K_r and (pygame.key.get_mods() & KMOD_CTRL):
+                elif event.key == K_r and (mods & KMOD_CTRL):
                     if (world.recording_enabled):
                         client.stop_recorder()
                         world.recording_enabled = False
@@ -252,7 +278,7 @@ class KeyboardControl(object):
                         client.start_recorder("manual_recording.rec")
                         world.recording_enabled = True
                         world.hud.notification("Recorder is ON")
-                elif event.key == K_p and (pygame.key.get_mods() & KMOD_CTRL):
+                elif event.key == K_p and (mods & KMOD_CTRL):
                     # stop recorder
                     client.stop_recorder()
                     world.recording_enabled = False
@@ -266,14 +292,14 @@ class KeyboardControl(object):
                     # replayer
                     client.replay_file("manual_recording.rec", world.recording_start, 0, 0)
                     world.camera_manager.set_sensor(currentIndex)
-                elif event.key == K_MINUS and (pygame.key.get_mods() & KMOD_CTRL):
-                    if pygame.key.get_mods() & KMOD_SHIFT:
+                elif event.key == K_MINUS and (mods & KMOD_CTRL):
+                    if mods & KMOD_SHIFT:
                         world.recording_start -= 10
                     else:
                         world.recording_start -= 1
                     world.hud.notification("Recording start time is %d" % (world.recording_start))
-                elif event.key == K_EQUALS and (pygame.key.get_mods() & KMOD_CTRL):
-                    if pygame.key.get_mods() & KMOD_SHIFT:
+                elif event.key == K_EQUALS and (mods & KMOD_CTRL):
+                    if mods & KMOD_SHIFT:
                         world.recording_start += 10
                     else:
                         world.recording_start += 1
@@ -290,16 +316,16 @@ class KeyboardControl(object):
                         self._control.gear = max(-1, self._control.gear - 1)
                     elif self._control.manual_gear_shift and event.key == K_PERIOD:
                         self._control.gear = self._control.gear + 1
-                    elif event.key == K_p and not (pygame.key.get_mods() & KMOD_CTRL):
+                    elif event.key == K_p and not (mods & KMOD_CTRL):
                         self._autopilot_enabled = not self._autopilot_enabled
                         world.player.set_autopilot(self._autopilot_enabled)
                         world.hud.notification(
                             'Autopilot %s' % ('On' if self._autopilot_enabled else 'Off'))
         if not self._autopilot_enabled:
             if isinstance(self._control, carla.VehicleControl):
-                keys = pygame.key.get_pressed()
-                if sum(keys) > 0:
-                    self._parse_vehicle_keys(keys, clock.get_time())
+                # Only poll the full keyboard state while a driving key is held.
+                if self._keys_down & self._VEHICLE_KEYS:
+                    self._parse_vehicle_keys(pygame.key.get_pressed(), clock.get_time())
                     self._control.reverse = self._control.gear < 0
                     world.player.apply_control(self._control)
             elif isinstance(self._control, carla.WalkerControl):
@@ -307,18 +333,19 @@ class KeyboardControl(object):
                 world.player.apply_control(self._control)
 
     def _parse_vehicle_keys(self, keys, milliseconds):
-        self._control.throttle = 1.0 if keys[K_UP] or keys[K_w] else 0.0
+        control = self._control
+        control.throttle = 1.0 if keys[K_UP] or keys[K_w] else 0.0
         steer_increment = 5e-4 * milliseconds
         if keys[K_LEFT] or keys[K_a]:
-            self._steer_cache -= steer_increment
+            steer_cache = self._steer_cache - steer_increment
         elif keys[K_RIGHT] or keys[K_d]:
-            self._steer_cache += steer_increment
+            steer_cache = self._steer_cache + steer_increment
         else:
-            self._steer_cache = 0.0
-        self._steer_cache = min(0.7, max(-0.7, self._steer_cache))
-        self._control.steer = round(self._steer_cache, 1)
-        self._control.brake = 1.0 if keys[K_DOWN] or keys[K_s] else 0.0
-        self._control.hand_brake = keys[K_SPACE]
+            steer_cache = 0.0
+        self._steer_cache = steer_cache = min(0.7, max(-0.7, steer_cache))
+        control.steer = round(steer_cache, 1)
+        control.brake = 1.0 if keys[K_DOWN] or keys[K_s] else 0.0
+        control.hand_brake = keys[K_SPACE]
 
     def _parse_walker_keys(self, keys, milliseconds):
         self._control.speed = 0.0
@@ -337,8 +364,8 @@ class KeyboardControl(object):
         self._control.direction = self._rotation.get_forward_vector()
 
     @staticmethod
-    def _is_quit_shortcut(key):
-        return (key == K_ESCAPE) or (key == K_q and pygame.key.get_mods() & KMOD_CTRL)
+    def _is_quit_shortcut(key, mods):
+        return (key == K_ESCAPE) or (key == K_q and mods & KMOD_CTRL)
 
 # ==============================================================================
 # -- HUD -----------------------------------------------------------------------
@@ -362,6 +389,26 @@ class HUD(object):
         self.simulation_time = 0
         self._show_info = True
         self._info_text = []
+        self._text_cache = {}
+        self._collision_offsets = np.arange(-200, 0, dtype=np.int64)
+        self._vehicles = []
+        self._vehicles_timestamp = None
+        # Bound templates for the info lines rebuilt on every tick.
+        self._fmt_server = 'Server:  {: 16.0f} FPS'.format
+        self._fmt_client = 'Client:  {: 16.0f} FPS'.format
+        self._fmt_vehicle = 'Vehicle: {:>20}'.format
+        self._fmt_map = 'Map:     {:>20}'.format
+        self._fmt_simulation_time = 'Simulation time: {!s:>12}'.format
+        self._fmt_speed = 'Speed:   {: 15.0f} km/h'.format
+        self._fmt_heading = u'Heading:{: 16.0f}\N{DEGREE SIGN} {:>2}'.format
+        self._fmt_location = 'Location:{:>20}'.format
+        self._fmt_location_xy = '({: 5.1f}, {: 5.1f})'.format
+        self._fmt_gnss = 'GNSS:{:>24}'.format
+        self._fmt_gnss_lat_lon = '({: 2.6f}, {: 3.6f})'.format
+        self._fmt_height = 'Height:  {: 18.0f} m'.format
+        self._fmt_gear = 'Gear:        {}'.format
+        self._fmt_vehicle_count = 'Number of vehicles: {: 8d}'.format
+        self._fmt_nearby_vehicle = '{: 4d}m {}'.format
         self._server_clock = pygame.time.Clock()
 
     def on_world_tick(self, timestamp):
@@ -374,31 +421,39 @@ class HUD(object):
         self._notifications.tick(world, clock)
         if not self._show_info:
             return
-        t = world.player.get_transform()
-        v = world.player.get_velocity()
-        c = world.player.get_control()
-        heading = 'N' if abs(t.rotation.yaw) < 89.5 else ''
-        heading += 'S' if abs(t.rotation.yaw) > 90.5 else ''
-        heading += 'E' if 179.5 > t.rotation.yaw > 0.5 else ''
-        heading += 'W' if -0.5 > t.rotation.yaw > -179.5 else ''
-        colhist = world.collision_sensor.get_collision_history()
-        collision = [colhist[x + self.frame - 200] for x in range(0, 200)]
-        max_col = max(1.0, max(collision))
-        collision = [x / max_col for x in collision]
-        vehicles = world.world.get_actors().filter('vehicle.*')
+        player = world.player
+        t = player.get_transform()
+        v = player.get_velocity()
+        c = player.get_control()
+        # Each carla attribute read goes through a binding getter; read them once.
+        location = t.location
+        x, y, z = location.x, location.y, location.z
+        yaw = t.rotation.yaw
+        heading = 'N' if abs(yaw) < 89.5 else ''
+        heading += 'S' if abs(yaw) > 90.5 else ''
+        heading += 'E' if 179.5 > yaw > 0.5 else ''
+        heading += 'W' if -0.5 > yaw > -179.5 else ''
+        collision = world.collision_sensor.get_collision_window(self._collision_offsets + self.frame)
+        collision = (collision / max(1.0, collision.max())).tolist()
+        # Listing the actors is a round-trip to the server; 2 Hz is plenty for the HUD.
+        now = time.monotonic()
+        if self._vehicles_timestamp is None or now - self._vehicles_timestamp > 0.5:
+            self._vehicles = world.world.get_actors().filter('vehicle.*')
+            self._vehicles_timestamp = now
+        vehicles = self._vehicles
         self._info_text = [
-            'Server:  % 16.0f FPS' % self.server_fps,
-            'Client:  % 16.0f FPS' % clock.get_fps(),
+            self._fmt_server(self.server_fps),
+            self._fmt_client(clock.get_fps()),
             '',
-            'Vehicle: % 20s' % get_actor_display_name(world.player, truncate=20),
-            'Map:     % 20s' % world.map.name,
-            'Simulation time: % 12s' % datetime.timedelta(seconds=int(self.simulation_time)),
+            self._fmt_vehicle(get_actor_display_name(player, truncate=20)),
+            self._fmt_map(world.map.name),
+            self._fmt_simulation_time(datetime.timedelta(seconds=int(self.simulation_time))),
             '',
-            'Speed:   % 15.0f km/h' % (3.6 * math.sqrt(v.x ** 2 + v.y ** 2 + v.z ** 2)),
-            u'Heading:% 16.0f\N{DEGREE SIGN} % 2s' % (t.rotation.yaw, heading),
-            'Location:% 20s' % ('(% 5.1f, % 5.1f)' % (t.location.x, t.location.y)),
-            'GNSS:% 24s' % ('(% 2.6f, % 3.6f)' % (world.gnss_sensor.lat, world.gnss_sensor.lon)),
-            'Height:  % 18.0f m' % t.location.z,
+            self._fmt_speed(3.6 * math.hypot(math.hypot(v.x, v.y), v.z)),
+            self._fmt_heading(yaw, heading),
+            self._fmt_location(self._fmt_location_xy(x, y)),
+            self._fmt_gnss(self._fmt_gnss_lat_lon(world.gnss_sensor.lat, world.gnss_sensor.lon)),
+            self._fmt_height(z),
             '']
         if isinstance(c, carla.VehicleControl):
             self._info_text += [
@@ -408,7 +463,7 @@ class HUD(object):
                 ('Reverse:', c.reverse),
                 ('Hand brake:', c.hand_brake),
                 ('Manual:', c.manual_gear_shift),
-                'Gear:        %s' % {-1: 'R', 0: 'N'}.get(c.gear, c.gear)]
+                self._fmt_gear({-1: 'R', 0: 'N'}.get(c.gear, c.gear))]
         elif isinstance(c, carla.WalkerControl):
             self._info_text += [
                 ('Speed:', c.speed, 0.0, 5.556),
@@ -418,18 +473,27 @@ class HUD(object):
             'Collision:',
             collision,
             '',
-            'Number of vehicles: % 8d' % len(vehicles)]
+            self._fmt_vehicle_count(len(vehicles))]
         if len(vehicles) > 1:
             self._info_text += ['Nearby vehicles:']
-
-            def distance(l): return math.sqrt(
-                (l.x - t.location.x) ** 2 + (l.y - t.location.y) ** 2 + (l.z - t.location.z) ** 2)
-            vehicles = [(distance(x.get_location()), x) for x in vehicles if x.id != world.player.id]
-            for d, vehicle in sorted(vehicles):
-                if d > 200.0:
-                    break
-                vehicle_type = get_actor_display_name(vehicle, truncate=22)
-                self._info_text.append('% 4dm %s' % (d, vehicle_type))
+            # Only as many vehicles as there are free HUD lines can be shown.
+            max_lines = max(0, (self.dim[1] - 4) // 18 - len(self._info_text))
+            player_id = player.id
+            # The actor list is cached, so skip anything destroyed since it was fetched.
+            vehicles = [a for a in vehicles if a.id != player_id and a.is_alive]
+            locations = np.array([(l.x, l.y, l.z) for l in (a.get_location() for a in vehicles)],
+                                 dtype=np.float64).reshape(-1, 3)
+            locations -= (x, y, z)
+            distances_sq = np.einsum('ij,ij->i', locations, locations)
+            nearby = np.flatnonzero(distances_sq <= 40000.0)
+            nearby = nearby[np.argsort(distances_sq[nearby], kind='stable')[:max_lines]]
+            for i in nearby:
+                vehicle_type = get_actor_display_name(vehicles[i], truncate=22)
+                self._info_text.append(self._fmt_nearby_vehicle(int(math.sqrt(distances_sq[i])), vehicle_type))
+
+    def invalidate_vehicles(self):
+        """Refetch the vehicle list on the next tick instead of using the cached one."""
+        self._vehicles_timestamp = None
 
     def toggle_info(self):
         self._show_info = not self._show_info
@@ -440,6 +504,16 @@ class HUD(object):
     def error(self, text):
         self._notifications.set_text('Error: %s' % text, (255, 0, 0))
 
+    def _render_text(self, text):
+        # Most info lines are unchanged between frames, so reuse their surfaces.
+        surface = self._text_cache.get(text)
+        if surface is None:
+            surface = self._font_mono.render(text, True, (255, 255, 255))
+            if len(self._text_cache) >= 256:
+                self._text_cache.pop(next(iter(self._text_cache)))
+            self._text_cache[text] = surface
+        return surface
+
     def render(self, display):
         if self._show_info:
             info_surface = pygame.Surface((220, self.dim[1]))
@@ -472,7 +546,7 @@ class HUD(object):
                         pygame.draw.rect(display, (255, 255, 255), rect)
                     item = item[0]
                 if item:  # At this point has to be a str.
-                    surface = self._font_mono.render(item, True, (255, 255, 255))
+                    surface = self._render_text(item)
                     display.blit(surface, (8, v_offset))
                 v_offset += 18
         self._notifications.render(display)
@@ -513,17 +587,21 @@ class FadingText(object):
 
 class HelpText(object):
     def __init__(self, font, width, height):
-        lines = __doc__.split('\n')
+        self._lines = __doc__.split('\n')
         self.font = font
-        self.dim = (680, len(lines) * 22 + 12)
+        self.dim = (680, len(self._lines) * 22 + 12)
         self.pos = (0.5 * width - 0.5 * self.dim[0], 0.5 * height - 0.5 * self.dim[1])
         self.seconds_left = 0
+        # Rasterized on first display; most sessions never open the help.
+        self.surface = None
+        self._render = False
+
+    def _rasterize(self):
         self.surface = pygame.Surface(self.dim)
         self.surface.fill((0, 0, 0, 0))
-        for n, line in enumerate(lines):
+        for n, line in enumerate(self._lines):
             text_texture = self.font.render(line, True, (255, 255, 255))
             self.surface.blit(text_texture, (22, n * 22))
-            self._render = False
         self.surface.set_alpha(220)
 
     def toggle(self):
@@ -531,6 +609,8 @@ class HelpText(object):
 
     def render(self, display):
         if self._render:
+            if self.surface is None:
+                self._rasterize()
             display.blit(self.surface, self.pos)
 
 # ==============================================================================
@@ -539,9 +619,17 @@ class HelpText(object):
 
 
 class CollisionSensor(object):
+    # Per-frame intensities are kept in a ring indexed by ``frame & _RING_MASK``.
+    # Each slot also remembers which frame it holds so that stale entries left
+    # over from a previous lap of the ring read back as zero.
+    _RING_SIZE = 4096
+    _RING_MASK = _RING_SIZE - 1
+    _NO_FRAME = -(1 << 62)
+
     def __init__(self, parent_actor, hud):
         self.sensor = None
-        self.history = []
+        self._ring = np.zeros(self._RING_SIZE, dtype=np.float32)
+        self._ring_frames = np.full(self._RING_SIZE, self._NO_FRAME, dtype=np.int64)
         self._parent = parent_actor
         self.hud = hud
         world = self._parent.get_world()
@@ -553,10 +641,15 @@ class CollisionSensor(object):
         self.sensor.listen(lambda event: CollisionSensor._on_collision(weak_self, event))
 
     def get_collision_history(self):
-        history = collections.defaultdict(int)
-        for frame, intensity in self.history:
-            history[frame] += intensity
-        return history
+        # Read back from the ring, so only the most recent collision frames are kept.
+        valid = self._ring_frames != self._NO_FRAME
+        return collections.defaultdict(
+            int, zip(self._ring_frames[valid].tolist(), self._ring[valid].tolist()))
+
+    def get_collision_window(self, frames):
+        """Summed collision intensity for each frame in the int64 array ``frames``."""
+        slots = frames & self._RING_MASK
+        return np.where(self._ring_frames[slots] == frames, self._ring[slots], 0.0)
 
     @staticmethod
     def _on_collision(weak_self, event):
@@ -566,10 +659,12 @@ class CollisionSensor(object):
         actor_type = get_actor_display_name(event.other_actor)
         self.hud.notification('Collision with %r' % actor_type)
         impulse = event.normal_impulse
-        intensity = math.sqrt(impulse.x ** 2 + impulse.y ** 2 + impulse.z ** 2)
-        self.history.append((event.frame, intensity))
-        if len(self.history) > 4000:
-            self.history.pop(0)
+        intensity = math.hypot(math.hypot(impulse.x, impulse.y), impulse.z)
+        slot = event.frame & self._RING_MASK
+        if self._ring_frames[slot] != event.frame:
+            self._ring_frames[slot] = event.frame
+            self._ring[slot] = 0.0
+        self._ring[slot] += intensity
 
 # ==============================================================================
 # -- LaneInvasionSensor --------------------------------------------------------
@@ -604,6 +699,8 @@ class LaneInvasionSensor(object):
 
 
 class GnssSensor(object):
+    __slots__ = ('sensor', '_parent', 'lat', 'lon', '__weakref__')
+
     def __init__(self, parent_actor):
         self.sensor = None
         self._parent = parent_actor
@@ -632,12 +729,42 @@ class GnssSensor(object):
 
 
 class CameraManager(object):
+    __slots__ = (
+        'sensor', 'surface', '_parent', 'hud', 'recording', '_save_executor', '_save_slots',
+        '_blit_lock', '_rgb_buffer', '_rgb_surface', '_u8', '_f4', '_parse_fn', '_lidar_scale',
+        '_lidar_offset', '_lidar_img', '_lidar_scratch', '_lidar_pixels', '_lidar_surface',
+        '_camera_transforms', 'transform_index', 'sensors',
+        '_bp_library', 'index', '__weakref__')
+
     def __init__(self, parent_actor, hud):
         self.sensor = None
         self.surface = None
         self._parent = parent_actor
         self.hud = hud
         self.recording = False
+        # Recorded frames are written by worker threads; at most 8 may be
+        # pending, further frames are dropped until the writers catch up.
+        self._save_executor = None
+        self._save_slots = threading.BoundedSemaphore(8)
+        # Held by render() while blitting and by the sensor callback while it
+        # writes a frame, so a frame is never overwritten halfway through a blit.
+        self._blit_lock = threading.Lock()
+        # Camera frames are converted into one row-major RGB buffer that a
+        # surface created once wraps without copying.
+        self._rgb_buffer = np.empty((hud.dim[1], hud.dim[0], 3), dtype=np.uint8)
+        self._rgb_surface = pygame.image.frombuffer(self._rgb_buffer, hud.dim, 'RGB')
+        self._u8 = np.dtype(np.uint8)
+        self._f4 = np.dtype(np.float32)
+        self._parse_fn = CameraManager._parse_camera
+        self._lidar_scale = np.float32(min(hud.dim) / 100.0)
+        self._lidar_offset = np.array((0.5 * hud.dim[0], 0.5 * hud.dim[1]), dtype=np.float32)
+        # Lidar frames are painted into one image and copied into one reused
+        # surface, under the same _blit_lock as the camera buffer.
+        self._lidar_img = np.zeros((hud.dim[0], hud.dim[1], 3), dtype=np.uint8)
+        # Scratch buffers for the projected points, grown to the largest cloud seen.
+        self._lidar_scratch = np.empty((0, 2), dtype=np.float32)
+        self._lidar_pixels = np.empty((0, 2), dtype=np.int32)
+        self._lidar_surface = pygame.Surface(hud.dim)
         self._camera_transforms = [
             carla.Transform(carla.Location(x=-5.5, z=2.8), carla.Rotation(pitch=-15)),
             carla.Transform(carla.Location(x=1.6, z=1.7))]
@@ -651,22 +778,23 @@ class CameraManager(object):
             ['sensor.camera.semantic_segmentation', cc.CityScapesPalette,
              'Camera Semantic Segmentation (CityScapes Palette)'],
             ['sensor.lidar.ray_cast', None, 'Lidar (Ray-Cast)']]
-        world = self._parent.get_world()
-        bp_library = world.get_blueprint_library()
-        for item in self.sensors:
-            bp = bp_library.find(item[0])
-            if item[0].startswith('sensor.camera'):
-                bp.set_attribute('image_size_x', str(hud.dim[0]))
-                bp.set_attribute('image_size_y', str(hud.dim[1]))
-            elif item[0].startswith('sensor.lidar'):
-                bp.set_attribute('range', '5000')
-            item.append(bp)
+        # Blueprints are looked up on first use of each sensor, see set_sensor().
+        self._bp_library = self._parent.get_world().get_blueprint_library()
         self.index = None
 
     def toggle_camera(self):
         self.transform_index = (self.transform_index + 1) % len(self._camera_transforms)
         self.sensor.set_transform(self._camera_transforms[self.transform_index])
 
+    def _find_blueprint(self, sensor_id):
+        bp = self._bp_library.find(sensor_id)
+        if sensor_id.startswith('sensor.camera'):
+            bp.set_attribute('image_size_x', str(self.hud.dim[0]))
+            bp.set_attribute('image_size_y', str(self.hud.dim[1]))
+        elif sensor_id.startswith('sensor.lidar'):
+            bp.set_attribute('range', '5000')
+        return bp
+
     def set_sensor(self, index, notify=True):
         index = index % len(self.sensors)
         needs_respawn = True if self.index is None \
@@ -675,6 +803,11 @@ class CameraManager(object):
             if self.sensor is not None:
                 self.sensor.destroy()
                 self.surface = None
+            # Pick the frame parser once here instead of testing the sensor type per frame.
+            self._parse_fn = CameraManager._parse_lidar if self.sensors[index][0].startswith('sensor.lidar') \
+                else CameraManager._parse_camera
+            if len(self.sensors[index]) == 3:
+                self.sensors[index].append(self._find_blueprint(self.sensors[index][0]))
             self.sensor = self._parent.get_world().spawn_actor(
                 self.sensors[index][-1],
                 self._camera_transforms[self.transform_index],
@@ -695,36 +828,63 @@ class CameraManager(object):
         self.hud.notification('Recording %s' % ('On' if self.recording else 'Off'))
 
     def render(self, display):
-        if self.surface is not None:
-            display.blit(self.surface, (0, 0))
+        with self._blit_lock:
+            if self.surface is not None:
+                display.blit(self.surface, (0, 0))
 
     @staticmethod
     def _parse_image(weak_self, image):
         self = weak_self()
         if not self:
             return
-        if self.sensors[self.index][0].startswith('sensor.lidar'):
-            points = np.frombuffer(image.raw_data, dtype=np.dtype('f4'))
-            points = np.reshape(points, (int(points.shape[0] / 3), 3))
-            lidar_data = np.array(points[:, :2])
-            lidar_data *= min(self.hud.dim) / 100.0
-            lidar_data += (0.5 * self.hud.dim[0], 0.5 * self.hud.dim[1])
-            lidar_data = np.fabs(lidar_data)  # pylint: disable=E1111
-            lidar_data = lidar_data.astype(np.int32)
-            lidar_data = np.reshape(lidar_data, (-1, 2))
-            lidar_img_size = (self.hud.dim[0], self.hud.dim[1], 3)
-            lidar_img = np.zeros(lidar_img_size)
-            lidar_img[tuple(lidar_data.T)] = (255, 255, 255)
-            self.surface = pygame.surfarray.make_surface(lidar_img)
-        else:
-            image.convert(self.sensors[self.index][1])
-            array = np.frombuffer(image.raw_data, dtype=np.dtype("uint8"))
-            array = np.reshape(array, (image.height, image.width, 4))
-            array = array[:, :, :3]
-            array = array[:, :, ::-1]
-            self.surface = pygame.surfarray.make_surface(array.swapaxes(0, 1))
-        if self.recording:
+        # Drop the frame rather than wait if the main thread is blitting.
+        if self._blit_lock.acquire(False):
+            try:
+                self._parse_fn(self, image)
+            finally:
+                self._blit_lock.release()
+        if self.recording and self._save_slots.acquire(False):
+            if self._save_executor is None:
+                self._save_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+            self._save_executor.submit(self._save_image, image)
+
+    def _parse_lidar(self, image):
+        width, height = self.hud.dim
+        points = np.frombuffer(image.raw_data, dtype=self._f4).reshape(-1, 3)
+        count = points.shape[0]
+        if self._lidar_scratch.shape[0] < count:
+            self._lidar_scratch = np.empty((count, 2), dtype=np.float32)
+            self._lidar_pixels = np.empty((count, 2), dtype=np.int32)
+        scratch = self._lidar_scratch[:count]
+        lidar_data = self._lidar_pixels[:count]
+        np.multiply(points[:, :2], self._lidar_scale, out=scratch)
+        np.add(scratch, self._lidar_offset, out=scratch)
+        np.abs(scratch, out=scratch)
+        np.copyto(lidar_data, scratch, casting='unsafe')
+        # Points beyond the window edge cannot be drawn.
+        lidar_data = lidar_data[(lidar_data[:, 0] < width) & (lidar_data[:, 1] < height)]
+        lidar_img = self._lidar_img
+        lidar_img.fill(0)
+        lidar_img[lidar_data[:, 0], lidar_data[:, 1]] = 255
+        pygame.surfarray.blit_array(self._lidar_surface, lidar_img)
+        self.surface = self._lidar_surface
+
+    def _parse_camera(self, image):
+        # cc.Raw leaves the pixels untouched, only palette conversions need the call.
+        converter = self.sensors[self.index][1]
+        if converter != cc.Raw:
+            image.convert(converter)
+        array = np.frombuffer(image.raw_data, dtype=self._u8)
+        array = np.reshape(array, (image.height, image.width, 4))
+        # BGRA -> RGB in a single copy; pygame wraps the buffer without swapaxes.
+        np.copyto(self._rgb_buffer, array[:, :, 2::-1])
+        self.surface = self._rgb_surface
+
+    def _save_image(self, image):
+        try:
             image.save_to_disk('_out/%08d' % image.frame)
+        finally:
+            self._save_slots.release()
 
 
 # ==============================================================================
@@ -732,11 +892,9 @@ class CameraManager(object):
 # ==============================================================================
 import lcm
 # 使用多线程的方法来监听LCM消息
-import threading, time
+import time
 from npc_control import connect_request, connect_response, Waypoint, action_result, action_package, end_connection, suspend_simulation, reset_simulation
 from collections import deque
-# 线程安全的队列实现
-from queue import Queue
 import queue
 connect_request_keyword = "connect_request"
 connect_response_keyword = "connect_response"
@@ -747,6 +905,13 @@ suspend_simulation_keyword = "suspend_simulation"
 reset_simulation_keyword = "reset_simulation"
 
 class Game_Loop:
+    # 这些成员会被监听线程、挂起检测线程和主循环频繁访问，使用__slots__省去实例字典查找
+    __slots__ = (
+        'init_waypoint', 'veh_id', 'init', 'should_publish', 'finish_current_action',
+        'message_waypoints', 'action_pack_count', 'agent', 'world', 'args', 'lc', 'msg_queue',
+        'action_result_count', 'self_drive', 'message_listener', 'suspend_simulation_dealer',
+        'publish_queue', 'message_publisher', 'stop_event', 'connect_event')
+
     def __init__(self, args):
         self.init_waypoint = None
         self.veh_id = None
@@ -759,10 +924,17 @@ class Game_Loop:
         self.world = None
         self.args = args
         self.lc = lcm.LCM()
-        self.msg_queue = Queue()
+        # 监听线程是唯一的生产者、主线程是唯一的消费者，deque的append/popleft
+        # 本身是原子操作，无需Queue的锁和条件变量
+        self.msg_queue = deque()
         self.action_result_count = 0
-        self.waypoints_buffer = deque(maxlen=600)
+        # 主循环只负责编码，由发布线程调用lc.publish，避免发布阻塞主循环
+        self.publish_queue = queue.SimpleQueue()
         self.self_drive = False
+        # 置位后各子线程退出循环，见shutdown()
+        self.stop_event = threading.Event()
+        # 收到初始化回应后由监听线程置位，主线程在握手阶段阻塞等待它
+        self.connect_event = threading.Event()
         self.init_controller()
     
     # 进一步对各类成员进行初始化工作
@@ -777,40 +949,62 @@ class Game_Loop:
         self.suspend_simulation_dealer = threading.Thread(target=self.suspend_simulation_control_process, name='SuspendSimulationThread')
         self.suspend_simulation_dealer.setDaemon(True)
         self.suspend_simulation_dealer.start()
+        self.message_publisher = threading.Thread(target=self.message_publish_process, name='MessagePublishThread')
+        self.message_publisher.setDaemon(True)
+        self.message_publisher.start()
 
     # 监听线程需要执行的过程，仅需要监听LCM消息并将消息放入消息队列等待主线程处理即可
     def message_listen_process(self):
+        while not self.stop_event.is_set():
+            # 有消息时立即返回，否则最多阻塞100ms，以便及时响应退出请求
+            self.lc.handle_timeout(100)
+
+    # 发布线程，依次发布主循环放入队列的(频道, 已编码消息)，收到None时退出
+    def message_publish_process(self):
         while True:
-            self.lc.handle()
+            item = self.publish_queue.get()
+            if item is None:
+                return
+            channel, data = item
+            self.lc.publish(channel, data)
 
     # 通过监听一段时间内发送action_result的个数来判断是否需要发送suspend_simulation
     def suspend_simulation_control_process(self):
         local_result_count = 0
         listening_interval = 1
         while True:
-            # 每隔若干秒查看一次
-            time.sleep(listening_interval)
-            print("action result count: ", self.action_result_count)
+            # 每隔若干秒查看一次，收到退出请求时立即返回
+            if self.stop_event.wait(listening_interval):
+                return
+            # 连接结束后不再发布任何消息，也就无需构造和编码
+            if not self.should_publish:
+                continue
+            logging.debug("action result count: %d", self.action_result_count)
             if local_result_count == self.action_result_count and local_result_count != 0:
-                print("no action result sent in ", listening_interval, " seconds, sending suspend simulation package.")
+                logging.debug("no action result sent in %s seconds, sending suspend simulation package.", listening_interval)
                 suspend = suspend_simulation()
                 suspend.vehicle_id = self.veh_id
                 suspend.current_pos = self.transform_to_lcm_waypoint(self.world.vehicle.get_transform())
-                if self.should_publish is True:
-                    self.lc.publish(suspend_simulation_keyword, suspend.encode())
+                self.lc.publish(suspend_simulation_keyword, suspend.encode())
             elif local_result_count == 0:
                 pack = reset_simulation()
                 pack.vehicle_id = self.veh_id
                 self.lc.publish(reset_simulation_keyword, pack.encode())
             else:
                 local_result_count = self.action_result_count
+
+    # 停止各子线程并等待其退出；发布线程会先发完队列中已有的消息
+    def shutdown(self, timeout=1.0):
+        self.stop_event.set()
+        self.publish_queue.put(None)
+        for thread in (self.message_listener, self.suspend_simulation_dealer, self.message_publisher):
+            thread.join(timeout)
+
     # from carla transform to lcm waypoint
     def transform_to_lcm_waypoint(self, transform):
         lcm_waypoint = Waypoint()
         lcm_waypoint.Location = [transform.location.x, -1 * transform.location.y, transform.location.z]
         lcm_waypoint.Rotation = [transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll]
-        print("lcm waypoint location: ", lcm_waypoint.Location)
-
         return lcm_waypoint
     
     def transform_waypoint(self, lcm_waypoint):
@@ -818,43 +1012,39 @@ class Game_Loop:
         transfrom from LCM waypoint structure to local_planner waypoint structure.
 
         """
-        new_waypoint = carla.libcarla.Transform()
-        new_waypoint.location.x = lcm_waypoint.Location[0]
-        new_waypoint.location.y = -1 * lcm_waypoint.Location[1]
-        new_waypoint.location.z = lcm_waypoint.Location[2]
-        new_waypoint.rotation.pitch = lcm_waypoint.Rotation[0]
-        new_waypoint.rotation.yaw = lcm_waypoint.Rotation[1] - 90.0
-        new_waypoint.rotation.roll = lcm_waypoint.Rotation[2]
-        return new_waypoint
+        location = lcm_waypoint.Location
+        rotation = lcm_waypoint.Rotation
+        return carla.Transform(
+            carla.Location(x=location[0], y=-1 * location[1], z=location[2]),
+            carla.Rotation(pitch=rotation[0], yaw=rotation[1] - 90.0, roll=rotation[2]))
     def action_package_handler(self, channel, data):
         msg = action_package.decode(data)
         if msg.vehicle_id != self.veh_id:
             return
-        print('receive message on channel ', channel)
+        logging.debug('receive message on channel %s', channel)
         # print('type of this message: ', type(msg))
         que_element = [action_package_keyword, msg]
-        self.msg_queue.put(que_element)
+        self.msg_queue.append(que_element)
 
-    # concrete dealer function of action package.
+    # concrete dealer function of action package, returns the waypoints converted to carla transforms.
     def action_package_dealer(self, msg):
         if msg.vehicle_id != self.veh_id:
-            print("invalid vehicle id from message! self id: ", self.veh_id)
-            return
+            logging.debug("invalid vehicle id from message! self id: %s", self.veh_id)
+            return []
         # print("len of msg waypoints: ", len(msg.waypoints))
-        for i in range(self.message_waypoints):
-            new_point = self.transform_waypoint(msg.waypoints[i])
-            # print("new point for vehicle ", msg.vehicle_id, ": ", new_point)
-            self.waypoints_buffer.append(new_point)
+        transform_waypoint = self.transform_waypoint
+        return [transform_waypoint(waypoint) for waypoint in msg.waypoints[:self.message_waypoints]]
 
         
     def connect_response_handler(self, channel, data):
         msg = connect_response.decode(data)
         if self.init:
             return
-        print('receive message on channel ', channel)
+        logging.debug('receive message on channel %s', channel)
         # print('type of this message: ', type(msg))
         que_element = [connect_response_keyword, msg]
-        self.msg_queue.put(que_element)
+        self.msg_queue.append(que_element)
+        self.connect_event.set()
     
     def connect_response_dealer(self, msg):
         self.veh_id = msg.vehicle_id
@@ -864,9 +1054,9 @@ class Game_Loop:
 
     def end_connection_dealer(self, channel, data):
         msg = end_connection.decode(data)
-        print('receive message on channel ', channel)
+        logging.debug('receive message on channel %s', channel)
         que_element = [end_connection_keyword, msg]
-        self.msg_queue.put(que_element)
+        self.msg_queue.append(que_element)
 
     def game_loop(self):
         pygame.init()
@@ -884,15 +1074,13 @@ class Game_Loop:
             self.lc.publish(connect_request_keyword, connect_request_msg.encode())
 
             print("connect request message publish done, waiting for connecting response...")
-            # 不断监听初始化回应的消息
+            # 阻塞等待初始化回应，回应入队后才会置位，因此之后队列中必有该消息
+            self.connect_event.wait()
             while True:
-                try:
-                    [keyword, msg] = self.msg_queue.get(timeout=0.01)
-                    if keyword == connect_response_keyword:
-                        self.connect_response_dealer(msg)
-                        break
-                except queue.Empty:
-                    continue
+                [keyword, msg] = self.msg_queue.popleft()
+                if keyword == connect_response_keyword:
+                    self.connect_response_dealer(msg)
+                    break
 
             hud = HUD(self.args.width, self.args.height)
             self.world = World(client.get_world(), hud, self.args.filter)
@@ -948,28 +1136,22 @@ class Game_Loop:
                 pygame.display.flip()
                 # 是否需要向SUMO服务器发送action result消息
                 should_publish_result_msg = False
-                try:
-                    [keyword, msg] = self.msg_queue.get(timeout=0.01)
+                # 每帧处理完队列中所有已到达的消息，避免消息在队列中积压
+                while self.msg_queue:
+                    [keyword, msg] = self.msg_queue.popleft()
                     # print("keyword of message is ", keyword)
                     # Receive an action package
                     if keyword == action_package_keyword:
-                        print("Receive an action package!")
+                        logging.debug("Receive an action package!")
                         self.agent.drop_waypoint_buffer()
                         # 在收到新的路点消息后丢弃当前缓冲中剩余的路点
-                        self.action_package_dealer(msg)
-                        # print("waypoint length: ", len(self.waypoints_buffer))
-                        for i in range(self.message_waypoints):
-                            temp_waypoint = self.waypoints_buffer.popleft()
-                    
-                            # print("waypoint in main loop is ", temp_waypoint)
-                            
-                            self.agent.add_waypoint(temp_waypoint)
-                        self.waypoints_buffer.clear()
+                        for waypoint in self.action_package_dealer(msg):
+                            self.agent.add_waypoint(waypoint)
                     elif keyword == connect_response_keyword:
                         self.connect_response_dealer(msg)
                     elif keyword == end_connection_keyword:
                         if msg.vehicle_id != self.veh_id:
-                            print("invalid vehicle id from end connection package")
+                            logging.debug("invalid vehicle id from end connection package")
                         else:
                             print("connection to SUMO ended.")
                             # self.agent.set_target_speed(20)
@@ -982,8 +1164,6 @@ class Game_Loop:
                             # return
                     else:
                         pass
-                except queue.Empty:
-                    pass
                 control = self.agent.run_step()
                 if control:
                     self.world.player.apply_control(control)
@@ -991,7 +1171,7 @@ class Game_Loop:
                 if self.agent.get_finished_waypoints() >= self.message_waypoints:
                     should_publish_result_msg = True
                 # 获取当前位置和速度信息并发送到SUMO服务器
-                if should_publish_result_msg:
+                if should_publish_result_msg and self.should_publish:
                     current_speed = self.world.player.get_velocity()
                     current_transform = self.world.player.get_transform()
                     action_res_pack = action_result()
@@ -1004,11 +1184,12 @@ class Game_Loop:
                         current_speed.z
                     ]
 
-                    self.lc.publish(action_result_keyword, action_res_pack.encode())
+                    self.publish_queue.put((action_result_keyword, action_res_pack.encode()))
                     self.action_result_count += 1
                     should_publish_result_msg = False
 
         finally:
+            self.shutdown()
             if self.world is not None:
                 self.world.destroy()
 
@@ -1,6 +1,9 @@
 """LCM type definitions
 This file automatically generated by lcm.
 DO NOT MODIFY BY HAND!!!!
+
+NOTE: this copy has been hand-edited after generation (precompiled structs,
+single-join encode). Regenerating it with lcm-gen will undo those changes.
 """
 
 try:
@@ -9,6 +12,9 @@ except ImportError:
     from io import BytesIO
 import struct
 
+_HDR_STRUCT = struct.Struct('>I')
+_FP_STRUCT = struct.Struct('>Q')
+
 class reset_simulation(object):
     __slots__ = ["vehicle_id"]
 
@@ -20,14 +26,14 @@ class reset_simulation(object):
         self.vehicle_id = ""
 
     def encode(self):
-        buf = BytesIO()
-        buf.write(reset_simulation._get_packed_fingerprint())
-        self._encode_one(buf)
-        return buf.getvalue()
+        __vehicle_id_encoded = self.vehicle_id.encode('utf-8')
+        return b"".join((reset_simulation._packed_fingerprint,
+                         _HDR_STRUCT.pack(len(__vehicle_id_encoded)+1),
+                         __vehicle_id_encoded, b"\0"))
 
     def _encode_one(self, buf):
         __vehicle_id_encoded = self.vehicle_id.encode('utf-8')
-        buf.write(struct.pack('>I', len(__vehicle_id_encoded)+1))
+        buf.write(_HDR_STRUCT.pack(len(__vehicle_id_encoded)+1))
         buf.write(__vehicle_id_encoded)
         buf.write(b"\0")
 
@@ -36,14 +42,14 @@ class reset_simulation(object):
             buf = data
         else:
             buf = BytesIO(data)
-        if buf.read(8) != reset_simulation._get_packed_fingerprint():
+        if buf.read(8) != reset_simulation._packed_fingerprint:
             raise ValueError("Decode error")
         return reset_simulation._decode_one(buf)
     decode = staticmethod(decode)
 
     def _decode_one(buf):
         self = reset_simulation()
-        __vehicle_id_len = struct.unpack('>I', buf.read(4))[0]
+        (__vehicle_id_len,) = _HDR_STRUCT.unpack_from(buf.read(4))
         self.vehicle_id = buf.read(__vehicle_id_len)[:-1].decode('utf-8', 'replace')
         return self
     _decode_one = staticmethod(_decode_one)
@@ -59,7 +65,10 @@ class reset_simulation(object):
 
     def _get_packed_fingerprint():
         if reset_simulation._packed_fingerprint is None:
-            reset_simulation._packed_fingerprint = struct.pack(">Q", reset_simulation._get_hash_recursive([]))
+            reset_simulation._packed_fingerprint = _FP_STRUCT.pack(reset_simulation._get_hash_recursive([]))
         return reset_simulation._packed_fingerprint
     _get_packed_fingerprint = staticmethod(_get_packed_fingerprint)
 
+# The fingerprint is constant, so pack it at import and let the hot paths read
+# reset_simulation._packed_fingerprint directly.
+reset_simulation._get_packed_fingerprint()